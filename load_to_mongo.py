@@ -1,7 +1,10 @@
+import argparse
 import os
-import json
 import zipfile
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pymongo import ASCENDING, MongoClient, UpdateOne
 
 # ==========================
 # CONFIG (update paths here)
@@ -11,8 +14,19 @@ DEVICES_ZIP = "devices-1681209661.csv.zip"
 MANUF_ZIP  = "manufacturers-1681209657.csv.zip"
 
 OUT_DIR = "cleaned_output"
+CSV_BLOCK_SIZE = 1 << 22  # bytes per Arrow parse block (the unit of parallel parsing)
+# pandas.read_csv's default NA markers (Arrow's defaults lack "None" and "<NA>")
+CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Mongo is only touched with --bootstrap-mongo / --reload-mongo
+MONGO_URI_DEFAULT = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
+MONGO_DB_DEFAULT  = os.getenv("MONGODB_DB", "medical_device_db")
+UPSERT_BATCH = 10_000
+
 # --------------------------
 # Helper to load CSV from ZIP
 # --------------------------
@@ -21,12 +35,47 @@ def load_csv_from_zip(zip_path):
         members = [n for n in z.namelist() if n.lower().endswith(".csv")]
         if not members:
             raise ValueError(f"No CSV inside {zip_path}")
-        with z.open(members[0]) as f:
-            return pd.read_csv(f, low_memory=False)
+        try:
+            with z.open(members[0]) as f:
+                table = pacsv.read_csv(
+                    f,
+                    read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                    parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                    convert_options=pacsv.ConvertOptions(
+                        null_values=CSV_NULL_VALUES, strings_can_be_null=True),
+                )
+            # not streamed: the whole table is built, then copied by to_pandas(),
+            # so peak memory is no lower than pd.read_csv; the gain is parse speed
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            # read_csv widens column types across blocks (a count column that turns
+            # to free text comes back as text), so this only catches files Arrow
+            # can't parse at all; the member is then parsed a second time by pandas
+            with z.open(members[0]) as f:
+                return pd.read_csv(f, low_memory=False)
+
+# --------------------------
+# Date helpers
+# --------------------------
+def parse_dates(s):
+    # the FDA dumps use ISO dates; an explicit format skips per-element dateutil inference.
+    # Some columns mix naive and "Z" values (Arrow may already hand back datetime64[UTC]):
+    # parse as UTC, then drop the zone so every date column shares one naive dtype
+    return pd.to_datetime(s, errors="coerce", format="ISO8601", utc=True).dt.tz_localize(None)
+
+def to_iso_date(dt):
+    return dt.dt.strftime("%Y-%m-%d").astype(object).where(dt.notna(), None)
 
 # --------------------------
 # Cleaning: Events
 # --------------------------
+ACTION_CLASSES = ["CLASS I", "CLASS II", "CLASS III"]
+ACTION_CLASS_MAP = {
+    "CLASS I": "CLASS I", "CLASS II": "CLASS II", "CLASS III": "CLASS III",
+    "CLASS 1": "CLASS I", "CLASS 2": "CLASS II", "CLASS 3": "CLASS III",
+    "I": "CLASS I", "II": "CLASS II", "III": "CLASS III",
+}
+
 def clean_events(df):
     keep = [c for c in [
         "id", "device_id", "action", "action_classification",
@@ -37,16 +86,23 @@ def clean_events(df):
     if "reason" in out: out["reason"] = out["reason"].fillna("Unknown")
     if "determined_cause" in out: out["determined_cause"] = out["determined_cause"].fillna("Unknown")
     if "action_classification" in out:
-        out["action_classification"] = (
-            out["action_classification"].astype(str).str.strip().str.upper()
-            .replace({"CLASS 1": "CLASS I","CLASS 2": "CLASS II","CLASS 3": "CLASS III",
-                      "I":"CLASS I","II":"CLASS II","III":"CLASS III"})
-        )
+        # one normalize pass + dict lookup; anything outside the three classes becomes missing
+        s = out["action_classification"].astype(str).str.strip().str.upper()
+        out["action_classification"] = pd.Categorical(s.map(ACTION_CLASS_MAP), categories=ACTION_CLASSES)
     # dates -> ISO string
+    dates = {}
     for col in ["date", "date_posted", "date_updated"]:
         if col in out:
-            out[col] = pd.to_datetime(out[col], errors="coerce").dt.strftime("%Y-%m-%d")
-            out[col] = out[col].where(out[col].notna(), None)
+            dates[col] = parse_dates(out[col])
+            out[col] = to_iso_date(dates[col])
+    # event_time: first of date / date_posted / date_updated, kept as a real datetime.
+    # Only the --reload-mongo path stores it as a BSON Date; the NDJSON output carries
+    # an ISO string, so Mongo imports of those files need --bootstrap-mongo afterwards
+    if dates:
+        event_time = None
+        for dt in dates.values():
+            event_time = dt if event_time is None else event_time.combine_first(dt)
+        out["event_time"] = event_time
     return out.drop_duplicates(subset=["id"])
 
 # --------------------------
@@ -65,8 +121,7 @@ def clean_devices(df):
     if "country" in out: out["country"] = out["country"].fillna("Unknown")
     for col in ["created_at", "updated_at"]:
         if col in out:
-            out[col] = pd.to_datetime(out[col], errors="coerce").dt.strftime("%Y-%m-%d")
-            out[col] = out[col].where(out[col].notna(), None)
+            out[col] = to_iso_date(parse_dates(out[col]))
     return out.drop_duplicates(subset=["id"])
 
 # --------------------------
@@ -82,20 +137,86 @@ def clean_manuf(df):
 # --------------------------
 # Save CSV + NDJSON
 # --------------------------
+def _arrow_table(df):
+    arrays = []
+    for c in df.columns:
+        try:
+            arrays.append(pa.array(df[c], from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed-type object column (e.g. counts alongside free text): write as text
+            s = df[c].astype(str).where(df[c].notna(), None)
+            arrays.append(pa.array(s, type=pa.string(), from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+
 def save_outputs(df, name):
     csv_path = os.path.join(OUT_DIR, f"clean_{name}.csv")
     json_path = os.path.join(OUT_DIR, f"clean_{name}.json")
-    df.to_csv(csv_path, index=False)
-    with open(json_path, "w", encoding="utf-8") as f:
-        for rec in df.to_dict(orient="records"):
-            clean = {k: (None if pd.isna(v) else v) for k, v in rec.items()}
-            f.write(json.dumps(clean, ensure_ascii=False) + "\n")
+    pacsv.write_csv(_arrow_table(df), csv_path)
+    # NaN/NaT -> null; datetimes as ISO 8601
+    df.to_json(json_path, orient="records", lines=True, date_format="iso",
+               force_ascii=False, double_precision=15)
     return csv_path, json_path
 
+# --------------------------
+# Mongo: bootstrap (non-destructive) + reload
+# --------------------------
+def backfill_event_time(db):
+    # history queries compare event_time with a datetime, so anything that isn't a
+    # BSON Date never matches: documents loaded before event_time existed, and ISO
+    # strings imported from the NDJSON output. Convert those server-side, falling back
+    # to the same date > date_posted > date_updated preference as clean_events
+    res = db.events.update_many(
+        {"event_time": {"$not": {"$type": "date"}}},
+        [{"$set": {"event_time": {"$convert": {
+            "input": {"$ifNull": ["$event_time", {"$ifNull": [
+                "$date", {"$ifNull": ["$date_posted", "$date_updated"]}]}]},
+            "to": "date", "onError": None, "onNull": None,
+        }}}}],
+    )
+    return res.modified_count
+
+def ensure_indexes(db):
+    # predict.py filters history by id and event_time <= as_of; create_index is a no-op if present
+    db.events.create_index([("device_id", ASCENDING), ("event_time", ASCENDING)])
+    db.events.create_index([("manufacturer_id", ASCENDING), ("event_time", ASCENDING)])
+    db.devices.create_index([("id", ASCENDING)])
+
+def bootstrap_mongo(db):
+    n = backfill_event_time(db)
+    ensure_indexes(db)
+    print(f"Backfilled event_time on {n} events and ensured indexes in {db.name}")
+
+def reload_mongo(db, frames):
+    # upsert keyed on _id = record id (the Spring repositories key on the integer _id);
+    # $set leaves fields the cleaner doesn't produce, such as slug, in place
+    for name, df in frames.items():
+        recs = df.astype(object).where(df.notna(), None).to_dict(orient="records")
+        for start in range(0, len(recs), UPSERT_BATCH):
+            ops = [UpdateOne({"_id": rec["id"]}, {"$set": rec}, upsert=True)
+                   for rec in recs[start:start + UPSERT_BATCH]]
+            db[name].bulk_write(ops, ordered=False)
+        print(f"Upserted {len(recs)} documents into {db.name}.{name}")
+
 # --------------------------
 # Main
 # --------------------------
+def parse_args():
+    ap = argparse.ArgumentParser(description="Clean the FDA CSV dumps into CSV + NDJSON (optionally into Mongo)")
+    ap.add_argument("--bootstrap-mongo", action="store_true",
+                    help="only convert event_time to a Date on existing events and ensure indexes (non-destructive)")
+    ap.add_argument("--reload-mongo", action="store_true",
+                    help="also upsert the cleaned collections into Mongo, then bootstrap")
+    ap.add_argument("--mongo_uri", default=MONGO_URI_DEFAULT)
+    ap.add_argument("--mongo_db",  default=MONGO_DB_DEFAULT)
+    return ap.parse_args()
+
 def main():
+    args = parse_args()
+    if args.bootstrap_mongo:
+        with MongoClient(args.mongo_uri) as client:
+            bootstrap_mongo(client[args.mongo_db])
+        return
+
     events_raw = load_csv_from_zip(EVENTS_ZIP)
     devices_raw = load_csv_from_zip(DEVICES_ZIP)
     manuf_raw  = load_csv_from_zip(MANUF_ZIP)
@@ -112,5 +233,11 @@ def main():
     for p in [e_csv, d_csv, m_csv, e_json, d_json, m_json]:
         print(" -", p)
 
+    if args.reload_mongo:
+        with MongoClient(args.mongo_uri) as client:
+            db = client[args.mongo_db]
+            reload_mongo(db, {"events": events, "devices": devices, "manufacturers": manuf})
+            bootstrap_mongo(db)
+
 if __name__ == "__main__":
     main()
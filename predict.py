@@ -17,6 +17,10 @@ python predict.py --task post_binary --reason "Battery overheating may cause bur
 python predict.py --task pre_multiclass --device_id D123 --risk_class III --classification "Cardiac Device" ^
   --implanted true --quantity_in_commerce 50000 --country USA --parent_company Abbott
 
+# Persistent service: models and the Mongo client stay loaded between requests.
+# POST a JSON object with the same keys as the flags (including "task").
+python predict.py --serve --port 8765
+
 Environment / Flags
 -------------------
 Models:
@@ -26,15 +30,22 @@ Models:
 Mongo:
   --mongo_uri    (default: env MONGODB_URI or mongodb://localhost:27017/)
   --mongo_db     (default: env MONGODB_DB or medical_device_db)
+  History lookups read events.event_time as a BSON Date; on a database loaded
+  before that field existed, or imported from the NDJSON files (where it is an
+  ISO string), run `python load_to_mongo.py --bootstrap-mongo` once to convert
+  it and create the (device_id|manufacturer_id, event_time) indexes.
 """
 
 from __future__ import annotations
-import argparse, json, os, sys
+import argparse, json, math, os, sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
 from pathlib import Path
 from typing import Any, Dict, Optional
 from datetime import datetime, timezone
 
 import joblib
+from cachetools import TTLCache, cached
 import pandas as pd
 from pymongo import MongoClient
 import numpy as np
@@ -61,6 +72,11 @@ TEXT_FIELDS = [
     "device_description", "device_name", "device_classification", "device_risk_class"
 ]
 
+PRE_INPUT_FIELDS = [
+    "device_id","manufacturer_id","risk_class","classification",
+    "implanted","quantity_in_commerce","country","parent_company"
+]
+
 PRE_FEATURES = [
     "risk_class","classification","implanted","quantity_in_commerce","country","parent_company",
     "device_past_recalls_total","dev_is_I_cum_past","dev_is_II_cum_past","dev_is_III_cum_past",
@@ -71,19 +87,50 @@ PRE_FEATURES = [
 # ---------- Utils ----------
 def eprint(*a, **k): print(*a, file=sys.stderr, **k)
 
+_TRUTHY = {"true","1","yes","y"}
+
 def _bool01(v) -> int:
     s = str(v).strip().lower()
-    return 1 if s in {"true","1","yes","y"} else 0
+    return 1 if s in _TRUTHY else 0
+
+def _bool01_series(s: pd.Series) -> pd.Series:
+    """Vectorized _bool01 for batch inputs (int8 0/1)."""
+    return s.astype(str).str.strip().str.lower().isin(_TRUTHY).astype(np.int8)
 
 def _to_float(v) -> float:
     try: return float(v)
     except: return 0.0
 
+# Process-wide caches; only pay off when the module outlives one prediction (--serve).
+_MODEL_CACHE: Dict[Path, Any] = {}
+_MONGO_CLIENTS: Dict[str, MongoClient] = {}
+_ENCODER_CACHE: Dict[int, Any] = {}
+# Mongo lookups memoized per (client, db, ids, day); the TTL bounds how stale a
+# served history can be after new events are loaded.
+_HISTORY_CACHE = TTLCache(maxsize=4096, ttl=300)
+_MANUFACTURER_CACHE = TTLCache(maxsize=4096, ttl=300)
+_HISTORY_LOCK, _MANUFACTURER_LOCK = Lock(), Lock()
+
 def _load_model(path: str | Path):
-    p = Path(path)
-    if not p.exists():
-        raise FileNotFoundError(f"Model file not found: {p}")
-    return joblib.load(p)
+    p = Path(path).resolve()
+    if p not in _MODEL_CACHE:
+        if not p.exists():
+            raise FileNotFoundError(f"Model file not found: {p}")
+        _MODEL_CACHE[p] = joblib.load(p)
+    return _MODEL_CACHE[p]
+
+def _mongo_client(mongo_uri: str) -> MongoClient:
+    if mongo_uri not in _MONGO_CLIENTS:
+        _MONGO_CLIENTS[mongo_uri] = MongoClient(mongo_uri)
+    return _MONGO_CLIENTS[mongo_uri]
+
+def preload(model_post: str | Path = POST_BINARY_MODEL_DEFAULT,
+            model_pre: str | Path = PRE_MULTICLASS_MODEL_DEFAULT,
+            mongo_uri: str = MONGO_URI_DEFAULT) -> None:
+    """Warm the model and Mongo client caches ahead of the first request."""
+    _load_model(model_post)
+    _load_model(model_pre)
+    _mongo_client(mongo_uri)
 
 def _concat_text_from_flags(ns: argparse.Namespace) -> str:
     parts = []
@@ -93,64 +140,145 @@ def _concat_text_from_flags(ns: argparse.Namespace) -> str:
             parts.append(str(v))
     return " ".join(parts).strip()
 
-# ---------- Mongo helpers ----------
-def _event_time_expr():
-    return {
-        "$ifNull": [
-            "$date",
-            { "$ifNull": ["$date_posted", "$date_updated"] }
-        ]
-    }
+# ---------- Single-row encoding ----------
+def _is_missing(v) -> bool:
+    return v is None or (isinstance(v, float) and math.isnan(v))
+
+def _compile_row_encoder(model):
+    pre = model.named_steps["prep"]
+    cat_slots, num_slots, width = [], [], 0
+    for name, trans, cols in pre.transformers_:
+        if name == "remainder":
+            continue
+        steps = list(trans.named_steps)
+        if name == "cat" and steps == ["imputer", "onehot"]:
+            imputer, onehot = trans.named_steps["imputer"], trans.named_steps["onehot"]
+            if onehot.drop is not None:
+                raise ValueError("onehot drop= is not supported")
+            infrequent = getattr(onehot, "infrequent_categories_", None) or [None] * len(cols)
+            for i, col in enumerate(cols):
+                infreq = set() if infrequent[i] is None else set(infrequent[i])
+                kept = [c for c in onehot.categories_[i] if c not in infreq]
+                # frequent categories in fit order, then one shared "infrequent" column
+                lookup = {c: width + k for k, c in enumerate(kept)}
+                lookup.update({c: width + len(kept) for c in infreq})
+                cat_slots.append((col, imputer.statistics_[i], lookup))
+                width += len(kept) + (1 if infreq else 0)
+        elif name == "num" and steps == ["imputer", "log1p"]:
+            imputer = trans.named_steps["imputer"]
+            for i, col in enumerate(cols):
+                num_slots.append((col, float(imputer.statistics_[i]), width))
+                width += 1
+        else:
+            raise ValueError(f"Unsupported preprocessing step: {name} {steps}")
+    if width != len(pre.get_feature_names_out()):
+        raise ValueError("Encoded width does not match the fitted preprocessor")
+
+    num_idx = [j for _, _, j in num_slots]
+
+    def encode(row: Dict[str, Any]) -> np.ndarray:
+        z = np.zeros((1, width))
+        for col, fill, lookup in cat_slots:
+            v = row.get(col)
+            j = lookup.get(fill if _is_missing(v) else v)
+            if j is not None:  # unknown categories encode to all zeros (handle_unknown="ignore")
+                z[0, j] = 1.0
+        # np.log1p, not math.log1p: the two can differ by one ulp, which is enough to
+        # move a value across an HGB bin threshold (thresholds sit on training values)
+        nums = np.array([fill if _is_missing(row.get(col)) else float(row.get(col))
+                         for col, fill, _ in num_slots])
+        z[0, num_idx] = np.log1p(np.maximum(nums, 0.0))
+        return z
+
+    # the encoder must give the same probabilities as the full pipeline, not just
+    # close encodings; probe the fill values and a spread of small counts
+    probe = [{**{col: fill for col, fill, _ in cat_slots},
+              **{col: float(k) for col, _, _ in num_slots}} for k in (0, 1, 2, 3, 7, 13, 100, 999)]
+    expected = model.predict_proba(pd.DataFrame(probe, columns=pre.feature_names_in_))
+    got = np.vstack([model[-1].predict_proba(encode(r)) for r in probe])
+    if not np.array_equal(expected, got):
+        raise ValueError("Row encoder disagrees with the fitted pipeline")
+    return encode
+
+def _row_encoder(model):
+    """
+    Single-row equivalent of the fitted "prep" ColumnTransformer (imputers,
+    one-hot lookup tables, log1p), built once per model. Skips the DataFrame and
+    pipeline dispatch that dominate per-prediction cost. None if the pipeline
+    doesn't have the expected shape; callers then use the model as-is.
+    """
+    key = id(model)
+    if key not in _ENCODER_CACHE:
+        try:
+            _ENCODER_CACHE[key] = _compile_row_encoder(model)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            _ENCODER_CACHE[key] = None
+    return _ENCODER_CACHE[key]
 
+# ---------- Mongo helpers ----------
+@cached(_MANUFACTURER_CACHE, lock=_MANUFACTURER_LOCK,
+        key=lambda db, device_id: (id(db.client), db.name, device_id))
 def _get_device_manufacturer_id(db, device_id: str) -> Optional[str]:
     doc = db.devices.find_one({"id": device_id}, {"manufacturer_id": 1, "_id": 0})
     return (doc or {}).get("manufacturer_id")
 
-def _device_history(db, device_id: str, as_of: datetime) -> Dict[str, Any]:
-    pipeline = [
-        {"$match": {"device_id": device_id}},
-        {"$addFields": {"event_time": _event_time_expr()}},
-        {"$match": {"event_time": {"$ne": None, "$lte": as_of}}},
+_DEV_EMPTY = {"dev_is_I_cum_past":0,"dev_is_II_cum_past":0,"dev_is_III_cum_past":0,
+              "device_past_recalls_total":0,"device_prev_time":None,"device_days_since_prev":-1}
+_MFR_EMPTY = {"mfr_is_I_cum_past":0,"mfr_is_II_cum_past":0,"mfr_is_III_cum_past":0,
+              "mfr_past_recalls_total":0,"mfr_prev_time":None,"mfr_days_since_prev":-1}
+
+def _history_group_stages():
+    return [
         {"$group": {"_id": "$action_classification", "cnt": {"$sum": 1}, "max_time": {"$max": "$event_time"}}},
         {"$group": {"_id": None, "by_class": {"$push": {"k": "$_id", "v": "$cnt"}}, "last_time": {"$max": "$max_time"}}},
         {"$project": {"_id": 0, "map": {"$arrayToObject": "$by_class"}, "last_time": 1}}
     ]
-    agg = list(db.events.aggregate(pipeline))
-    if not agg:
-        return {"dev_is_I_cum_past":0,"dev_is_II_cum_past":0,"dev_is_III_cum_past":0,
-                "device_past_recalls_total":0,"device_prev_time":None,"device_days_since_prev":-1}
+
+def _unpack_history(agg, as_of: datetime):
     m = agg[0].get("map", {}) or {}
     last = agg[0].get("last_time")
     cI, cII, cIII = int(m.get("CLASS I",0)), int(m.get("CLASS II",0)), int(m.get("CLASS III",0))
-    total = cI + cII + cIII
     dsp = -1 if last is None else (as_of - last.replace(tzinfo=timezone.utc)).days
-    return {"dev_is_I_cum_past":cI,"dev_is_II_cum_past":cII,"dev_is_III_cum_past":cIII,
-            "device_past_recalls_total":total,"device_prev_time":last,"device_days_since_prev":dsp}
-
-def _manufacturer_history(db, manufacturer_id: str, as_of: datetime) -> Dict[str, Any]:
+    return cI, cII, cIII, cI + cII + cIII, last, dsp
+
+@cached(_HISTORY_CACHE, lock=_HISTORY_LOCK,
+        key=lambda db, device_id, manufacturer_id, as_of:
+            (id(db.client), db.name, device_id, manufacturer_id, as_of.date()))
+def _histories(db, device_id: Optional[str], manufacturer_id: Optional[str],
+               as_of: datetime) -> tuple[Dict[str, Any], Dict[str, Any]]:
+    """Device and manufacturer history in a single $facet round-trip."""
+    dev_counts, mfr_counts = dict(_DEV_EMPTY), dict(_MFR_EMPTY)
+    match_any, facet = [], {}
+    if device_id:
+        match_any.append({"device_id": device_id, "event_time": {"$lte": as_of}})
+        facet["dev"] = [{"$match": {"device_id": device_id}}] + _history_group_stages()
+    if manufacturer_id:
+        match_any.append({"manufacturer_id": manufacturer_id, "event_time": {"$lte": as_of}})
+        facet["mfr"] = [{"$match": {"manufacturer_id": manufacturer_id}}] + _history_group_stages()
+    if not facet:
+        return dev_counts, mfr_counts
+
+    # event_time is a Date materialized by load_to_mongo.py (--reload-mongo or
+    # --bootstrap-mongo), so both branches can use the (device_id|manufacturer_id,
+    # event_time) indexes directly
     pipeline = [
-        {"$match": {"manufacturer_id": manufacturer_id}},
-        {"$addFields": {"event_time": _event_time_expr()}},
-        {"$match": {"event_time": {"$ne": None, "$lte": as_of}}},
-        {"$group": {"_id": "$action_classification", "cnt": {"$sum": 1}, "max_time": {"$max": "$event_time"}}},
-        {"$group": {"_id": None, "by_class": {"$push": {"k": "$_id", "v": "$cnt"}}, "last_time": {"$max": "$max_time"}}},
-        {"$project": {"_id": 0, "map": {"$arrayToObject": "$by_class"}, "last_time": 1}}
+        {"$match": {"$or": match_any}},
+        {"$facet": facet}
     ]
-    agg = list(db.events.aggregate(pipeline))
-    if not agg:
-        return {"mfr_is_I_cum_past":0,"mfr_is_II_cum_past":0,"mfr_is_III_cum_past":0,
-                "mfr_past_recalls_total":0,"mfr_prev_time":None,"mfr_days_since_prev":-1}
-    m = agg[0].get("map", {}) or {}
-    last = agg[0].get("last_time")
-    cI, cII, cIII = int(m.get("CLASS I",0)), int(m.get("CLASS II",0)), int(m.get("CLASS III",0))
-    total = cI + cII + cIII
-    dsp = -1 if last is None else (as_of - last.replace(tzinfo=timezone.utc)).days
-    return {"mfr_is_I_cum_past":cI,"mfr_is_II_cum_past":cII,"mfr_is_III_cum_past":cIII,
-            "mfr_past_recalls_total":total,"mfr_prev_time":last,"mfr_days_since_prev":dsp}
+    res = next(db.events.aggregate(pipeline), {})
+
+    if res.get("dev"):
+        cI, cII, cIII, total, last, dsp = _unpack_history(res["dev"], as_of)
+        dev_counts = {"dev_is_I_cum_past":cI,"dev_is_II_cum_past":cII,"dev_is_III_cum_past":cIII,
+                      "device_past_recalls_total":total,"device_prev_time":last,"device_days_since_prev":dsp}
+    if res.get("mfr"):
+        cI, cII, cIII, total, last, dsp = _unpack_history(res["mfr"], as_of)
+        mfr_counts = {"mfr_is_I_cum_past":cI,"mfr_is_II_cum_past":cII,"mfr_is_III_cum_past":cIII,
+                      "mfr_past_recalls_total":total,"mfr_prev_time":last,"mfr_days_since_prev":dsp}
+    return dev_counts, mfr_counts
 
 def _build_pre_features_with_mongo_from_flags(ns: argparse.Namespace, mongo_uri: str, mongo_db: str) -> Dict[str, Any]:
-    client = MongoClient(mongo_uri)
-    db = client[mongo_db]
+    db = _mongo_client(mongo_uri)[mongo_db]
     as_of = datetime.now(timezone.utc)
 
     out = {
@@ -167,15 +295,7 @@ def _build_pre_features_with_mongo_from_flags(ns: argparse.Namespace, mongo_uri:
     if not manufacturer_id and device_id:
         manufacturer_id = _get_device_manufacturer_id(db, device_id)
 
-    dev_counts = {"dev_is_I_cum_past":0,"dev_is_II_cum_past":0,"dev_is_III_cum_past":0,
-                  "device_past_recalls_total":0,"device_prev_time":None,"device_days_since_prev":-1}
-    if device_id:
-        dev_counts = _device_history(db, device_id, as_of)
-
-    mfr_counts = {"mfr_is_I_cum_past":0,"mfr_is_II_cum_past":0,"mfr_is_III_cum_past":0,
-                  "mfr_past_recalls_total":0,"mfr_prev_time":None,"mfr_days_since_prev":-1}
-    if manufacturer_id:
-        mfr_counts = _manufacturer_history(db, manufacturer_id, as_of)
+    dev_counts, mfr_counts = _histories(db, device_id, manufacturer_id, as_of)
 
     out.update({
         "device_past_recalls_total": dev_counts["device_past_recalls_total"],
@@ -189,7 +309,6 @@ def _build_pre_features_with_mongo_from_flags(ns: argparse.Namespace, mongo_uri:
         "mfr_is_III_cum_past": mfr_counts["mfr_is_III_cum_past"],
         "mfr_days_since_prev": mfr_counts["mfr_days_since_prev"],
     })
-    client.close()
     return out
 
 # ---------- Predictors ----------
@@ -235,12 +354,21 @@ def run_pre_multiclass_from_flags(ns: argparse.Namespace, model_path: str | Path
     model = _load_model(model_path)
     features = _build_pre_features_with_mongo_from_flags(ns, mongo_uri, mongo_db)
     row = {k: features.get(k, "") for k in PRE_FEATURES}
-    X = pd.DataFrame([row])
 
-    yhat = model.predict(X)
+    encode = _row_encoder(model)
+    if encode is not None:
+        est, X = model[-1], encode(row)
+    else:
+        est, X = model, pd.DataFrame([row])
+
+    if hasattr(est,"predict_proba"):
+        proba = est.predict_proba(X)[0]
+        # predict() is argmax over predict_proba for these classifiers; don't score twice
+        yhat = [est.classes_[int(np.argmax(proba))]]
+    else:
+        proba, yhat = None, est.predict(X)
     out = {"task":"pre_multiclass","pred_class": str(yhat[0])}
-    if hasattr(model,"predict_proba"):
-        proba = model.predict_proba(X)[0]
+    if proba is not None:
         classes = list(getattr(model,"classes_", []))
         if classes and len(classes)==len(proba):
             out["probabilities"] = {str(c): float(round(p,6)) for c,p in zip(classes, proba)}
@@ -250,10 +378,60 @@ def run_pre_multiclass_from_flags(ns: argparse.Namespace, model_path: str | Path
     out["computed_history_present"] = True
     return out
 
+def run_from_namespace(ns: argparse.Namespace) -> Dict[str, Any]:
+    if ns.task == "post_binary":
+        return run_post_binary_from_flags(ns, ns.model_post)
+    if ns.task == "pre_multiclass":
+        return run_pre_multiclass_from_flags(ns, ns.model_pre, ns.mongo_uri, ns.mongo_db)
+    raise ValueError(f"Unknown task: {ns.task!r} (expected post_binary or pre_multiclass)")
+
+# ---------- Service ----------
+class _PredictHandler(BaseHTTPRequestHandler):
+    defaults: argparse.Namespace
+
+    def do_POST(self):
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(n) or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("Request body must be a JSON object")
+            ns = argparse.Namespace(**vars(self.defaults))
+            # only input fields are overridable; model paths / Mongo settings stay server-side
+            for k in ["task"] + TEXT_FIELDS + PRE_INPUT_FIELDS:
+                if k in payload:
+                    setattr(ns, k, payload[k])
+            status, out = 200, run_from_namespace(ns)
+        except ValueError as e:  # bad input, including json.JSONDecodeError
+            status, out = 400, {"error": str(e)}
+        except Exception as e:  # server-side: Mongo unavailable, model load, ...
+            eprint(f"[serve] ERROR: {type(e).__name__}: {e}")
+            status, out = 500, {"error": str(e)}
+        body = json.dumps(out, ensure_ascii=False, separators=(",",":")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        eprint(f"[serve] {self.address_string()} {fmt % args}")
+
+def serve(ns: argparse.Namespace) -> None:
+    preload(ns.model_post, ns.model_pre, ns.mongo_uri)
+    handler = type("PredictHandler", (_PredictHandler,), {"defaults": ns})
+    server = ThreadingHTTPServer((ns.host, ns.port), handler)
+    eprint(f"Serving predictions on http://{ns.host}:{ns.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 # ---------- CLI ----------
 def parse_args():
     ap = argparse.ArgumentParser(description="Unified predictor (flags-friendly)")
-    ap.add_argument("--task", required=True, choices=["post_binary","pre_multiclass"])
+    ap.add_argument("--task", choices=["post_binary","pre_multiclass"])
 
     # POST text flags (use any subset)
     for f in TEXT_FIELDS: ap.add_argument(f"--{f}")
@@ -274,15 +452,24 @@ def parse_args():
 
     # Pretty print
     ap.add_argument("--pretty", action="store_true")
-    return ap.parse_args()
+
+    # Persistent service
+    ap.add_argument("--serve", action="store_true", help="run as an HTTP service instead of one-shot")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+
+    ns = ap.parse_args()
+    if not ns.serve and not ns.task:
+        ap.error("--task is required unless --serve is given")
+    return ns
 
 def main():
     ns = parse_args()
+    if ns.serve:
+        serve(ns)
+        return
     try:
-        if ns.task == "post_binary":
-            out = run_post_binary_from_flags(ns, ns.model_post)
-        else:
-            out = run_pre_multiclass_from_flags(ns, ns.model_pre, ns.mongo_uri, ns.mongo_db)
+        out = run_from_namespace(ns)
     except Exception as e:
         eprint(f"ERROR: {e}")
         sys.exit(3)
@@ -1,13 +1,13 @@
 # train_multiclass_no_device_dates.py
 import os
-import json
 import numpy as np
 import pandas as pd
+import polars as pl
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OneHotEncoder, FunctionTransformer
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.metrics import classification_report, confusion_matrix
 from sklearn.impute import SimpleImputer
 from sklearn.utils import shuffle
@@ -16,14 +16,8 @@ from joblib import dump
 # -----------------------------
 # Helpers
 # -----------------------------
-def load_ndjson(path):
-    rows = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            s = line.strip()
-            if s:
-                rows.append(json.loads(s))
-    return pd.DataFrame(rows)
+CLASSES = ["CLASS I","CLASS II","CLASS III"]
+CLASS_FLAGS = ["is_I","is_II","is_III"]
 
 def first_existing(paths):
     for p in paths:
@@ -31,87 +25,97 @@ def first_existing(paths):
             return p
     raise FileNotFoundError(paths)
 
-def to_dt(s):
-    return pd.to_datetime(s, errors="coerce")
-
-def one_hot_flags(series):
-    s = series.fillna("UNK").astype(str)
-    return (s == "CLASS I").astype(int), (s == "CLASS II").astype(int), (s == "CLASS III").astype(int)
+ID_COLS = ["id", "device_id", "manufacturer_id"]
+DATE_COLS = ["date", "date_posted", "date_updated", "event_time"]
+
+def scan_ndjson(path):
+    # full-file schema inference: some columns (e.g. quantity_in_commerce) mix numbers and text
+    lf = pl.scan_ndjson(path, infer_schema_length=None)
+    # pin the dtypes that joins and date parsing rely on: an id column with a null
+    # is exported as 2.0 (f64), and an all-null date column is inferred as Null
+    names = lf.collect_schema().names()
+    return lf.with_columns(
+        [pl.col(c).cast(pl.Int64) for c in ID_COLS if c in names]
+        + [pl.col(c).cast(pl.String) for c in DATE_COLS if c in names]
+    )
+
+def one_hot_flags():
+    return [pl.col("action_classification").eq(cls).cast(pl.Int32).alias(flag)
+            for cls, flag in zip(CLASSES, CLASS_FLAGS)]
+
+def past_counts(key, prefix):
+    # per-key running count of each class flag, shifted within the key so a row
+    # only sees earlier events; expects the frame sorted by (key, event_time)
+    exprs = []
+    for flag in CLASS_FLAGS:
+        cum = pl.col(flag).cum_sum().shift(1).over(key)
+        exprs.append(
+            pl.when(pl.col(key).is_not_null()).then(cum.fill_null(0)).otherwise(0)
+            .cast(pl.Int32)  # counts fit easily; half the bytes of the old float64
+            .alias(f"{prefix}_{flag}_cum_past")
+        )
+    return exprs
 
 # -----------------------------
 # 1) Load data (events/devices/manufacturers)
 # -----------------------------
+# The ETL below (sections 1-3) is one lazy Polars plan, collected once into pandas.
 events_path = first_existing(["clean_events_with_slug.json", "clean_events.json"])
 devices_path = first_existing(["clean_devices_with_slug.json", "clean_devices.json"])
 manufs_path  = first_existing(["clean_manufacturers_with_slug.json", "clean_manufacturers.json"])
 
-events = load_ndjson(events_path)
-devices = load_ndjson(devices_path)
-manufs  = load_ndjson(manufs_path)
+events = scan_ndjson(events_path)
+devices = scan_ndjson(devices_path)
+manufs  = scan_ndjson(manufs_path)
 
 # Keep labeled events and with a device_id
-events = events[events["action_classification"].isin(["CLASS I","CLASS II","CLASS III"])]
-events = events[events["device_id"].notna()]
+events = events.filter(
+    pl.col("action_classification").is_in(CLASSES) & pl.col("device_id").is_not_null()
+)
+# class flags computed once; both history windows reuse them
+events = events.with_columns(one_hot_flags())
 
 # Build a reliable event_time for ordering history:
+# load_to_mongo.py materializes it at ingest; for older exports,
 # prefer 'date', else 'date_posted', else 'date_updated'
-for c in ["date","date_posted","date_updated"]:
-    if c in events.columns:
-        events[c] = to_dt(events[c])
-
-def choose_event_time(row):
-    for c in ["date","date_posted","date_updated"]:
-        if c in events.columns:
-            v = row.get(c)
-            if pd.notna(v):
-                return v
-    return pd.NaT
-
-events["event_time"] = events.apply(choose_event_time, axis=1)
+event_cols = events.collect_schema().names()
+if "event_time" in event_cols:
+    event_time = pl.col("event_time").str.to_datetime(strict=False)
+else:
+    event_time = pl.coalesce([pl.col(c).str.to_datetime(strict=False)
+                              for c in ["date","date_posted","date_updated"] if c in event_cols])
+events = events.with_columns(event_time.alias("event_time"))
 # drop events without any time info (can't create past counts safely)
-events = events[pd.notna(events["event_time"])].copy()
+events = events.filter(pl.col("event_time").is_not_null())
 
 # -----------------------------
 # 2) Join events → devices → manufacturers (no device date usage)
 # -----------------------------
-events = events.merge(
-    devices.rename(columns={"id":"device_pk"}),
-    left_on="device_id", right_on="device_pk",
-    how="left", suffixes=("","_device")
-)
-events = events.merge(
-    manufs.rename(columns={"id":"manufacturer_pk"}),
-    left_on="manufacturer_id", right_on="manufacturer_pk",
-    how="left", suffixes=("","_manuf")
-)
+events = events.join(devices, left_on="device_id", right_on="id", how="left", suffix="_device")
+events = events.join(manufs, left_on="manufacturer_id", right_on="id", how="left", suffix="_manuf")
 
 # -----------------------------
 # 3) Leak-safe history features
 # -----------------------------
-# Sort by (device_id, event_time) and create cumulative counts shifted by 1
-events = events.sort_values(["device_id","event_time"])
-eI, eII, eIII = one_hot_flags(events["action_classification"])
-events["dev_is_I"], events["dev_is_II"], events["dev_is_III"] = eI, eII, eIII
-
-for col in ["dev_is_I","dev_is_II","dev_is_III"]:
-    events[col+"_cum_past"] = events.groupby("device_id")[col].cumsum().shift(1).fillna(0)
-
-events["device_past_recalls_total"] = (
-    events["dev_is_I_cum_past"] + events["dev_is_II_cum_past"] + events["dev_is_III_cum_past"]
+# Sort by (device_id, event_time) and create cumulative counts shifted by 1;
+# event id breaks same-day ties so the features are reproducible run to run
+events = (events.sort(["device_id","event_time","id"], maintain_order=True)
+          .with_columns(past_counts("device_id", "dev")))
+events = events.with_columns(
+    pl.sum_horizontal("dev_is_I_cum_past", "dev_is_II_cum_past", "dev_is_III_cum_past")
+    .alias("device_past_recalls_total")
 )
 
 # Manufacturer history
-events = events.sort_values(["manufacturer_id","event_time"])
-mI, mII, mIII = one_hot_flags(events["action_classification"])
-events["mfr_is_I"], events["mfr_is_II"], events["mfr_is_III"] = mI, mII, mIII
-
-for col in ["mfr_is_I","mfr_is_II","mfr_is_III"]:
-    events[col+"_cum_past"] = events.groupby("manufacturer_id")[col].cumsum().shift(1).fillna(0)
-
-events["mfr_past_recalls_total"] = (
-    events["mfr_is_I_cum_past"] + events["mfr_is_II_cum_past"] + events["mfr_is_III_cum_past"]
+events = (events.sort(["manufacturer_id","event_time","id"], maintain_order=True)
+          .with_columns(past_counts("manufacturer_id", "mfr")))
+events = events.with_columns(
+    pl.sum_horizontal("mfr_is_I_cum_past", "mfr_is_II_cum_past", "mfr_is_III_cum_past")
+    .alias("mfr_past_recalls_total")
 )
 
+events = events.collect().to_pandas()
+
 # -----------------------------
 # 4) Feature table (inputs + label)
 # -----------------------------
@@ -139,9 +143,11 @@ df = events[needed].copy()
 
 # Types
 for c in bool_cols:
-    df[c] = df[c].map(lambda x: 1 if str(x).strip().lower() in {"true","1","yes","y"} else 0)
+    s = df[c].astype(str).str.strip().str.lower()
+    df[c] = s.isin({"true","1","yes","y"}).astype(np.int8)
 for c in num_cols:
     df[c] = pd.to_numeric(df[c], errors="coerce")
+df["quantity_in_commerce"] = df["quantity_in_commerce"].astype(np.float32)
 
 # Drop rows without label
 df = df[df[label_col].notna()]
@@ -163,7 +169,8 @@ numeric_transform = Pipeline(steps=[
 
 categorical_transform = Pipeline(steps=[
     ("imputer", SimpleImputer(strategy="most_frequent")),
-    ("onehot", OneHotEncoder(handle_unknown="ignore", min_frequency=0.01)),
+    # dense output: HistGradientBoosting does not take sparse input
+    ("onehot", OneHotEncoder(handle_unknown="ignore", min_frequency=0.01, sparse_output=False)),
 ])
 
 preprocessor = ColumnTransformer(
@@ -174,16 +181,15 @@ preprocessor = ColumnTransformer(
     remainder="drop"
 )
 
+# Histogram-binned boosting: shallow trees over uint8 bins, so single-row
+# predict_proba is far cheaper than walking a 400-tree random forest.
 clf = Pipeline(steps=[
     ("prep", preprocessor),
-    ("rf", RandomForestClassifier(
-        n_estimators=400,
-        max_depth=None,
-        min_samples_split=4,
-        min_samples_leaf=2,
-        class_weight="balanced_subsample",
+    ("hgb", HistGradientBoostingClassifier(
+        max_iter=400,
+        learning_rate=0.1,
+        early_stopping=False,
         random_state=42,
-        n_jobs=-1
     ))
 ])
 